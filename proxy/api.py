@@ -1,18 +1,72 @@
+import asyncio
+import functools
+import io
+import json
 import logging
-from typing import Union, List, Dict
+import re
+from typing import Union, List, Dict, FrozenSet, Optional, Tuple
+from xml.sax import saxutils
 
+import cachetools
 import fastapi
+import httpx
+import ijson
 import jsonpath_ng
-import requests
+import orjson
 import xmltodict
 from starlette import responses
+from starlette.middleware.gzip import GZipMiddleware
+
+from proxy import batcher
 
 logger = logging.getLogger(__name__)
 
 app = fastapi.FastAPI(title='Cryptocurrency data API for Google Sheets')
+# Sheets sends Accept-Encoding: gzip; compress anything non-trivial
+app.add_middleware(GZipMiddleware, minimum_size=500)
 
 ROOT_KEY = 'result'
 COINGECKO_ADDRESS = 'https://api.coingecko.com/api/v3/'
+CACHE_TTL_SECONDS = 10
+
+# query params captured by the routes (everything else is forwarded upstream)
+_JSONPATH_ARGS = frozenset(('jsonpath',))
+_URL_JSONPATH_ARGS = frozenset(('url', 'jsonpath'))
+
+# parsed upstream responses, keyed by (url, params): Sheets re-requests
+# the same URL from many cells in quick succession
+_response_cache = cachetools.TTLCache(maxsize=1024, ttl=CACHE_TTL_SECONDS)
+
+# in-flight upstream fetches, so concurrent identical requests
+# (e.g. a whole Sheets column expanding at once) share one fetch
+_inflight: Dict[tuple, asyncio.Future] = {}
+
+client: httpx.AsyncClient = None
+
+
+@app.on_event('startup')
+async def _startup_client():
+    """ create the shared upstream client on the running event loop """
+    global client
+    client = httpx.AsyncClient(
+        # coingecko routes are passed relative to base_url; the /any
+        # endpoints pass absolute URLs which override it
+        base_url=COINGECKO_ADDRESS,
+        timeout=10,
+        # multiplex concurrent upstream calls over one TLS connection
+        http2=True,
+        # ask upstream for compressed payloads explicitly
+        headers={'Accept-Encoding': 'gzip'},
+        # keep upstream sockets open between Sheets refreshes to avoid
+        # paying the TCP + TLS handshake on every call
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    )
+
+
+@app.on_event('shutdown')
+async def _shutdown_client():
+    await client.aclose()
+
 
 @app.get('/', response_class=responses.HTMLResponse)
 def health():
@@ -25,7 +79,7 @@ def health():
 
 
 @app.get("/xml/coingecko/{route:path}", response_class=responses.PlainTextResponse)
-def get_xml_coingecko(route: str, _request: fastapi.Request, jsonpath: str = None) -> str:
+async def get_xml_coingecko(route: str, _request: fastapi.Request, jsonpath: str = None):
     """
     GET JSON data from any route of the CoinGecko API and encode it as XML, optionally extracting
     parts from it using [JSONPath](https://goessner.net/articles/JsonPath/).
@@ -54,14 +108,14 @@ def get_xml_coingecko(route: str, _request: fastapi.Request, jsonpath: str = Non
         ids=bitcoin&vs_currencies=usd&jsonpath=bitcoin.usd", "result")
     ```
     """
-    return _get_request_to_xml(
-        url=f'{COINGECKO_ADDRESS}{route}',
-        params=_upcaptured_query_params(_request, ['jsonpath']),
+    return await _get_request_to_xml(
+        url=route,
+        params=_upcaptured_query_params(_request, _JSONPATH_ARGS),
         jsonpath=jsonpath)
 
 
 @app.get("/xml/any/{url:path}", response_class=responses.PlainTextResponse)
-def get_xml_any(url: str, _request: fastapi.Request, jsonpath: str = None) -> str:
+async def get_xml_any(url: str, _request: fastapi.Request, jsonpath: str = None):
     """
     GET any JSON from any API and encode it as XML, optionally extracting
     parts from it using [JSONPath](https://goessner.net/articles/JsonPath/).
@@ -91,14 +145,14 @@ def get_xml_any(url: str, _request: fastapi.Request, jsonpath: str = None) -> st
             "result")
     ```
     """
-    return _get_request_to_xml(
+    return await _get_request_to_xml(
         url=url,
-        params=_upcaptured_query_params(_request, ['url', 'jsonpath']),
+        params=_upcaptured_query_params(_request, _URL_JSONPATH_ARGS),
         jsonpath=jsonpath)
 
 
 @app.get("/value/coingecko/{route:path}", response_class=responses.PlainTextResponse)
-def get_value_coingecko(route: str, jsonpath: str, _request: fastapi.Request) -> str:
+async def get_value_coingecko(route: str, jsonpath: str, _request: fastapi.Request) -> str:
     """
     GET any value from any route of the CoinGecko API by extracting it
     using [JSONPath](https://goessner.net/articles/JsonPath/).
@@ -122,15 +176,15 @@ def get_value_coingecko(route: str, jsonpath: str, _request: fastapi.Request) ->
     ```
 
     """
-    return _get_request_to_value(
-        url=f'{COINGECKO_ADDRESS}{route}',
-        params=_upcaptured_query_params(_request, ['jsonpath']),
+    return await _get_request_to_value(
+        url=route,
+        params=_upcaptured_query_params(_request, _JSONPATH_ARGS),
         jsonpath=jsonpath,
     )
 
 
 @app.get("/value/any/{url:path}", response_class=responses.PlainTextResponse)
-def get_value_any(url: str, jsonpath: str, _request: fastapi.Request) -> str:
+async def get_value_any(url: str, jsonpath: str, _request: fastapi.Request) -> str:
     """
     GET any value from any API returning a JSON by extracting the
     value using [JSONPath](https://goessner.net/articles/JsonPath/).
@@ -158,100 +212,312 @@ def get_value_any(url: str, jsonpath: str, _request: fastapi.Request) -> str:
     ```
 
     """
-    return _get_request_to_value(
+    return await _get_request_to_value(
         url=url,
-        params=_upcaptured_query_params(_request, ['url', 'jsonpath']),
+        params=_upcaptured_query_params(_request, _URL_JSONPATH_ARGS),
         jsonpath=jsonpath,
     )
 
 
-def _upcaptured_query_params(request: fastapi.Request, expected_args: List[str]
-                             ) -> dict:
+def _upcaptured_query_params(request: fastapi.Request,
+                             expected_args: FrozenSet[str]) -> dict:
     """
     Extract any query params that are not captured because of `&` splitting.
     """
-    return {k: v for k, v in request.query_params.items()
-            if k not in expected_args}
+    query_params = request.query_params
+    # C-level set difference on the keys view instead of a per-key check
+    return {k: query_params[k] for k in query_params.keys() - expected_args}
+
+
+@functools.lru_cache(maxsize=512)
+def _parse_jsonpath(expr: str):
+    """
+    Parse and cache a jsonpath expression (parsing is expensive
+    since jsonpath_ng rebuilds its PLY parser on every call).
+    """
+    return jsonpath_ng.parse(expr)
+
+
+# plain dotted / indexed paths like `bitcoin.usd` or `[1].email`:
+# the common case in Sheets formulas, cheap to walk by hand
+_SIMPLE_JSONPATH_RE = re.compile(
+    r'^(?:[A-Za-z_]\w*|\[\d+\])(?:\.[A-Za-z_]\w*|\[\d+\])*$')
+_SIMPLE_JSONPATH_TOKEN_RE = re.compile(r'[A-Za-z_]\w*|\[\d+\]')
+
+
+def _jsonpath_values(result: Union[dict, list], jsonpath: str) -> list:
+    """
+    Extracts jsonpath matches from a result, walking simple
+    dotted/indexed paths directly and falling back to jsonpath_ng
+    for full jsonpath syntax (wildcards, filters, etc.).
+    """
+    if _SIMPLE_JSONPATH_RE.match(jsonpath):
+        try:
+            for token in _SIMPLE_JSONPATH_TOKEN_RE.findall(jsonpath):
+                result = (result[int(token[1:-1])] if token.startswith('[')
+                          else result[token])
+            return [result]
+        except (KeyError, IndexError, TypeError):
+            return []  # same as jsonpath_ng: no match
+
+    return [match.value for match in _parse_jsonpath(jsonpath).find(result)]
+
+
+def _cache_key(url: str, params: dict) -> tuple:
+    return (url, tuple(sorted(params.items())))
+
+
+async def _cached_single_flight(key: tuple, fetch):
+    """
+    Runs `fetch` at most once per `key`: results are served from the
+    short TTL cache, and concurrent callers with the same key await the
+    single in-flight fetch instead of issuing their own.
+    """
+    try:
+        return _response_cache[key]
+    except KeyError:
+        pass
 
+    if key in _inflight:
+        # shield the shared future: a cancelled waiter must not cancel
+        # the fetch out from under the leader and the other waiters
+        return await asyncio.shield(_inflight[key])
 
-def _get_request_to_xml(url: str, params: dict, jsonpath: str = None) -> str:
-    """ send a get request and convert to XML optionally applying jsonpath"""
+    future = asyncio.get_event_loop().create_future()
+    _inflight[key] = future
     try:
-        response = requests.get(url, params=params)
-        if not response.ok:
-            raise fastapi.HTTPException(response.status_code, response.text)
-        result = response.json()
-        result = _try_apply_jsonpath(result, jsonpath) if jsonpath else result
+        result = await fetch()
+        _response_cache[key] = result
+        if not future.done():
+            future.set_result(result)
+        return result
+
+    except Exception as e:
+        if not future.done():
+            future.set_exception(e)
+            future.exception()  # mark as retrieved in case no one awaits
+        raise
+
+    finally:
+        if not future.done():
+            # e.g. the leading request was cancelled (client disconnect):
+            # release the coalesced waiters instead of stranding them
+            future.cancel()
+        _inflight.pop(key, None)
+
+
+async def _checked_get(url: str, params: dict) -> httpx.Response:
+    """ GET upstream, raising on HTTP error statuses """
+    response = await client.get(url, params=params)
+    if response.is_error:
+        # decode the raw bytes directly: response.text would run
+        # charset detection over the body
+        raise fastapi.HTTPException(
+            response.status_code, response.content.decode('utf-8', 'replace'))
+    return response
+
+
+async def _fetch_json(url: str, params: dict) -> Union[dict, list]:
+    """ GET the upstream JSON, cached and coalesced per (url, params) """
+
+    async def fetch():
+        response = await _checked_get(url, params)
+        # orjson silently floats integers outside the 64-bit range,
+        # which could corrupt values from arbitrary /any upstreams
+        # (e.g. wei-scale balances) — stdlib json keeps those exact.
+        # CoinGecko's own payloads are safe for the fast path.
+        if _is_coingecko_route(url):
+            return orjson.loads(response.content)
+        return json.loads(response.content)
+
+    return await _cached_single_flight(_cache_key(url, params), fetch)
+
+
+async def _fetch_value(url: str, params: dict, prefix: str) -> str:
+    """
+    GET upstream JSON and stream-parse only the value at `prefix`
+    (a dotted path) instead of building the whole document.
+    Cached and coalesced like _fetch_json, keyed per prefix.
+    """
+
+    async def fetch():
+        response = await _checked_get(url, params)
+        for value in ijson.items(io.BytesIO(response.content), prefix):
+            return str(value)
+        raise ValueError(f'match for {prefix} not found')
+
+    return await _cached_single_flight(
+        _cache_key(url, params) + (prefix,), fetch)
+
+
+_SIMPLE_PRICE_ROUTE = 'simple/price'
+_price_batcher = batcher.SimplePriceBatcher(
+    fetch=lambda params: _fetch_json(_SIMPLE_PRICE_ROUTE, params))
+
+
+def _is_coingecko_route(url: str) -> bool:
+    """ coingecko calls pass bare routes, /any endpoints absolute URLs """
+    return '://' not in url
+
+
+def _is_batchable(url: str, params: dict) -> bool:
+    """ plain simple/price calls that the micro-batcher can merge """
+    return url == _SIMPLE_PRICE_ROUTE and set(params) == {'ids', 'vs_currencies'}
+
+
+async def _fetch_json_batched(url: str, params: dict) -> Union[dict, list]:
+    """
+    Fetch upstream JSON, micro-batching CoinGecko `simple/price` calls
+    (other routes and parameter combinations go straight through).
+    """
+    if _is_batchable(url, params):
+        return await _price_batcher.get(params['ids'], params['vs_currencies'])
+    return await _fetch_json(url, params)
+
+
+def _ijson_prefix(jsonpath: str) -> str:
+    """
+    A plain dotted path without list indices maps directly to an ijson
+    prefix; returns None for anything else.
+    """
+    if _SIMPLE_JSONPATH_RE.match(jsonpath) and '[' not in jsonpath:
+        return jsonpath
+    return None
+
+
+async def _get_request_to_xml(url: str, params: dict, jsonpath: str = None
+                              ) -> responses.PlainTextResponse:
+    """ send a get request and convert to an XML response,
+    optionally applying jsonpath """
+    try:
+        result = await _fetch_json_batched(url, params)
+        if jsonpath:
+            result, jsonpath_error = _try_apply_jsonpath(result, jsonpath)
+            if jsonpath_error is not None:
+                result = _with_jsonpath_error(result, jsonpath_error)
 
     except Exception as e:
         result = f'error: {str(e)}'
 
-    return _to_xml(result)
+    # bytes content is passed through without a re-encoding pass
+    return responses.PlainTextResponse(_to_xml(result))
 
 
-def _get_request_to_value(url: str, params: dict, jsonpath: str) -> str:
+async def _get_request_to_value(url: str, params: dict, jsonpath: str) -> str:
     """ send a get request and extract value using jsonpath"""
     try:
-        response = requests.get(url, params=params)
-        return _single_value_jsonpath_result(response, jsonpath)
+        # for dotted paths, stream-parse just the requested value unless
+        # the full document is already cached or the call is batchable
+        prefix = _ijson_prefix(jsonpath)
+        if (prefix is not None and not _is_batchable(url, params)
+                and _cache_key(url, params) not in _response_cache):
+            return await _fetch_value(url, params, prefix)
+
+        result = await _fetch_json_batched(url, params)
+        return _single_value_jsonpath_result(result, jsonpath)
 
     except Exception as e:
         return f'error: {str(e)}'
 
 
-def _single_value_jsonpath_result(response: requests.Response, jsonpath: str
+def _single_value_jsonpath_result(result: Union[dict, list], jsonpath: str
                                   ) -> str:
     """
-    Checks and extracts a single value from the response according to the jsonpath.
+    Checks and extracts a single value from the result according to the jsonpath.
     """
-    if not response.ok:
-        raise fastapi.HTTPException(response.status_code, response.text)
-
-    result = response.json()
-
-    # jsonpath
-    values = [match.value for match in jsonpath_ng.parse(jsonpath).find(result)]
+    values = _jsonpath_values(result, jsonpath)
 
     if not len(values):
         raise ValueError(f'match for {jsonpath} not found')
     if len(values) > 1:
         raise ValueError(f'more than one match for {jsonpath}')
 
-    return str(values[0])
+    value = values[0]
+    # numbers (the typical IMPORTDATA payload) format faster through
+    # orjson's C path; exact type check keeps bools as 'True'/'False'
+    if type(value) in (int, float):
+        return orjson.dumps(value).decode()
+    return str(value)
 
 
 def _try_apply_jsonpath(result: Union[dict, list],
                         jsonpath: str
-                        ) -> Union[dict, list]:
-    """ Applies jsonpath expression or adds the error that results from trying """
+                        ) -> Tuple[Union[dict, list], Optional[str]]:
+    """
+    Applies jsonpath expression, returning (extracted result, None),
+    or (unchanged result, error message) if the attempt failed.
+    """
     try:
-        values = [match.value for match in jsonpath_ng.parse(jsonpath).find(result)]
+        values = _jsonpath_values(result, jsonpath)
         if len(values) == 1:
-            result = values[0]
-        elif not len(values):
+            return values[0], None
+        if not len(values):
             raise ValueError(f'match for {jsonpath} not found')
-        else:
-            result = values
+        return values, None
 
     except Exception as e:
-        err_info = {'jsonpath-error': str(e)}
-        if isinstance(result, dict):
-            result.update(err_info)
-        else:
-            result.append(err_info)
-        logger.error(f'jsonpath error: {e}')
+        logger.error('jsonpath error: %s', e)
+        return result, str(e)
+
+
+def _with_jsonpath_error(result: Union[dict, list], error: str
+                         ) -> Union[dict, list]:
+    """
+    Adds the jsonpath error to a copy of the result for rendering
+    (the original may be shared via the response cache).
+    """
+    err_info = {'jsonpath-error': error}
+    if isinstance(result, dict):
+        return {**result, **err_info}
+    return result + [err_info]
+
 
-    return result
+_XML_TAG_RE = re.compile(r'^[A-Za-z_][\w.-]*$')
 
 
-def _to_xml(result: Union[List, Dict]) -> str:
+def _to_xml(result: Union[List, Dict]) -> bytes:
     """
-    Wraps a result in a single root structure
-    suitable for XML, and converts to XML
+    Wraps a result in a single root structure suitable for XML, and
+    converts to XML bytes (pre-encoded so the response layer doesn't
+    re-encode the whole document).
     """
     if isinstance(result, list):
         single_root = {ROOT_KEY: {'items': result}}
     else:
         single_root = {ROOT_KEY: result}
 
-    return xmltodict.unparse(single_root, pretty=True)
+    try:
+        out = [b'<?xml version="1.0" encoding="utf-8"?>\n']
+        _write_xml(ROOT_KEY, single_root[ROOT_KEY], out)
+        return b''.join(out)
+
+    except ValueError:
+        # keys that aren't valid XML tags, or unexpected nesting:
+        # leave those to xmltodict
+        return xmltodict.unparse(single_root, pretty=True).encode()
+
+
+def _write_xml(tag: str, obj, out: List[bytes]):
+    """
+    Appends `obj` to `out` as an XML element named `tag`. Much faster
+    than xmltodict.unparse for the simple JSON shapes served here.
+    """
+    if not _XML_TAG_RE.match(tag):
+        raise ValueError(f'invalid XML tag: {tag}')
+
+    if isinstance(obj, dict):
+        out.append(f'<{tag}>'.encode())
+        for key, value in obj.items():
+            if isinstance(value, list):
+                # xmltodict semantics: a list becomes repeated elements
+                for item in value:
+                    _write_xml(key, item, out)
+            else:
+                _write_xml(key, value, out)
+        out.append(f'</{tag}>'.encode())
+    elif isinstance(obj, list):
+        raise ValueError('list nested directly in list')
+    elif obj is None:
+        out.append(f'<{tag}></{tag}>'.encode())
+    else:
+        out.append(f'<{tag}>{saxutils.escape(str(obj))}</{tag}>'.encode())
@@ -0,0 +1,71 @@
+import asyncio
+from typing import Awaitable, Callable
+
+MAX_WAIT_SECONDS = 0.02
+
+
+class SimplePriceBatcher:
+    """
+    Micro-batches CoinGecko `simple/price` calls: the endpoint accepts
+    comma-separated `ids` and `vs_currencies`, so calls arriving within
+    a short window (e.g. many Sheets cells expanding at once) are merged
+    into a single upstream request and split back per caller.
+    """
+
+    def __init__(self,
+                 fetch: Callable[[dict], Awaitable[dict]],
+                 max_wait: float = MAX_WAIT_SECONDS):
+        self._fetch = fetch
+        self._max_wait = max_wait
+        self._pending = []  # (ids, vs_currencies, future) per caller
+        self._drain_task = None
+
+    async def get(self, ids: str, vs_currencies: str) -> dict:
+        """
+        Request prices for comma-separated `ids` / `vs_currencies`,
+        sharing one upstream call with other requests in the same window.
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append(
+            (ids.split(','), vs_currencies.split(','), future))
+        if self._drain_task is None or self._drain_task.done():
+            self._drain_task = asyncio.get_event_loop().create_task(
+                self._drain())
+        return await future
+
+    async def _drain(self):
+        """ wait out the batching window, fetch the union, demux results """
+        await asyncio.sleep(self._max_wait)
+        pending, self._pending = self._pending, []
+
+        try:
+            merged_params = {
+                'ids': ','.join(sorted(set().union(*(p[0] for p in pending)))),
+                'vs_currencies': ','.join(sorted(set().union(*(p[1] for p in pending)))),
+            }
+            try:
+                merged = await self._fetch(merged_params)
+            except Exception as e:
+                for *_, future in pending:
+                    # a caller may have been cancelled while waiting
+                    if not future.done():
+                        future.set_exception(e)
+                        future.exception()  # mark as retrieved
+                return
+
+            for ids, vs_currencies, future in pending:
+                if future.done():
+                    continue  # caller cancelled while the fetch was in flight
+                future.set_result({
+                    coin: {currency: merged[coin][currency]
+                           for currency in vs_currencies
+                           if currency in merged[coin]}
+                    for coin in ids if coin in merged})
+
+        finally:
+            # calls that arrived while the fetch was in flight saw a
+            # not-yet-done drain task, so they rely on us opening the
+            # next window for them
+            if self._pending:
+                self._drain_task = asyncio.get_event_loop().create_task(
+                    self._drain())
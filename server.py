@@ -5,4 +5,6 @@ if __name__ == '__main__':
     uvicorn.run('proxy.api:app',
                 host="0.0.0.0",
                 port=int(os.environ.get('UVICORN_PORT', 9000)),
+                loop='uvloop',
+                http='httptools',
                 log_level='info')
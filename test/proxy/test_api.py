@@ -9,7 +9,10 @@ XML_ROOT = api.ROOT_KEY
 
 @pytest.fixture(scope='module')
 def api_client():
-    return testclient.TestClient(api.app)
+    # context manager runs the startup/shutdown events
+    # that create the upstream client
+    with testclient.TestClient(api.app) as client:
+        yield client
 
 
 @pytest.mark.integration
@@ -140,3 +143,53 @@ class TestValueGet:
         res = api_client.get(f'{self.route}/{url}',
                              params=dict(jsonpath=jsonpath))
         assert 'error' in res.text and error_text in res.text
+
+
+class TestToXML:
+    """ the handwritten XML writer should round-trip like xmltodict """
+
+    @pytest.mark.parametrize('result', [
+        {'bitcoin': {'usd': 5, 'aud': 7.5}},
+        {'value': 'a "joke" with <tags> & ampersands'},
+        [{'email': 'a@b.c'}, {'email': 'd@e.f'}],
+        'error: something went wrong',
+        {'coin': {'tags': ['a', 'b'], 'none': None}},
+    ])
+    def test_round_trip(self, result):
+        data = xmltodict.parse(api._to_xml(result))
+        reference = xmltodict.parse(xmltodict.unparse(
+            {XML_ROOT: {'items': result}} if isinstance(result, list)
+            else {XML_ROOT: result}, pretty=True))
+        assert data == reference
+
+    @pytest.mark.parametrize('result', [
+        {'ns:tag': 1},  # namespaced keys
+        {'a': {'@attr': 'v', '#text': 'body'}},  # xmltodict attribute keys
+    ])
+    def test_edge_cases_fall_back_to_xmltodict(self, result):
+        assert api._to_xml(result) == xmltodict.unparse(
+            {XML_ROOT: result}, pretty=True).encode()
+
+
+class TestJsonpathValues:
+    """ the simple-path fast walker should agree with jsonpath_ng """
+
+    result = {
+        'bitcoin': {'usd': 5, 'tags': ['a', 'b']},
+        'comments': [{'email': 'a@b.c'}, {'email': 'd@e.f'}],
+    }
+
+    @pytest.mark.parametrize('jsonpath', [
+        'bitcoin.usd',
+        'bitcoin.tags[1]',
+        'comments[0].email',
+        'bitcoin.missing',  # no match
+        'comments[10].email',  # index out of range
+        'comments[*].email',  # wildcard: jsonpath_ng path
+        'bitcoin.usd.nested',  # path into a scalar
+    ])
+    def test_agrees_with_jsonpath_ng(self, jsonpath):
+        import jsonpath_ng
+        reference = [match.value
+                     for match in jsonpath_ng.parse(jsonpath).find(self.result)]
+        assert api._jsonpath_values(self.result, jsonpath) == reference
@@ -0,0 +1,110 @@
+import asyncio
+
+from proxy import batcher
+
+
+class FakeFetch:
+    """ records merged params and answers with a canned price table """
+
+    def __init__(self, prices):
+        self.prices = prices
+        self.calls = []
+
+    async def __call__(self, params):
+        self.calls.append(params)
+        return {coin: currencies for coin, currencies in self.prices.items()
+                if coin in params['ids'].split(',')}
+
+
+class TestSimplePriceBatcher:
+
+    prices = {
+        'bitcoin': {'usd': 1.0, 'aud': 2.0},
+        'ethereum': {'usd': 3.0, 'aud': 4.0},
+    }
+
+    def test_merges_and_demuxes(self):
+        fetch = FakeFetch(self.prices)
+        price_batcher = batcher.SimplePriceBatcher(fetch, max_wait=0.01)
+
+        async def main():
+            return await asyncio.gather(
+                price_batcher.get('bitcoin', 'usd'),
+                price_batcher.get('ethereum', 'usd,aud'),
+                price_batcher.get('bitcoin,ethereum', 'aud'),
+            )
+
+        res_1, res_2, res_3 = asyncio.get_event_loop().run_until_complete(main())
+
+        # one upstream call with the union of ids and currencies
+        assert fetch.calls == [{'ids': 'bitcoin,ethereum',
+                                'vs_currencies': 'aud,usd'}]
+        # each caller only sees what it asked for
+        assert res_1 == {'bitcoin': {'usd': 1.0}}
+        assert res_2 == {'ethereum': {'usd': 3.0, 'aud': 4.0}}
+        assert res_3 == {'bitcoin': {'aud': 2.0}, 'ethereum': {'aud': 4.0}}
+
+    def test_unknown_coin_missing_from_result(self):
+        fetch = FakeFetch(self.prices)
+        price_batcher = batcher.SimplePriceBatcher(fetch, max_wait=0.01)
+
+        result = asyncio.get_event_loop().run_until_complete(
+            price_batcher.get('bitcoin,dogecoin', 'usd'))
+        assert result == {'bitcoin': {'usd': 1.0}}
+
+    def test_fetch_error_propagates_to_all_callers(self):
+        async def failing_fetch(params):
+            raise ValueError('rate limited')
+
+        price_batcher = batcher.SimplePriceBatcher(failing_fetch, max_wait=0.01)
+
+        async def main():
+            return await asyncio.gather(
+                price_batcher.get('bitcoin', 'usd'),
+                price_batcher.get('ethereum', 'usd'),
+                return_exceptions=True)
+
+        results = asyncio.get_event_loop().run_until_complete(main())
+        assert all(isinstance(res, ValueError) for res in results)
+
+    def test_get_during_slow_fetch_is_not_stranded(self):
+        calls = []
+
+        async def slow_fetch(params):
+            calls.append(params)
+            await asyncio.sleep(0.2)
+            return self.prices
+
+        price_batcher = batcher.SimplePriceBatcher(slow_fetch, max_wait=0.01)
+
+        async def main():
+            first = asyncio.ensure_future(price_batcher.get('bitcoin', 'usd'))
+            # arrives after the window closed, while the fetch is in flight
+            await asyncio.sleep(0.1)
+            second = asyncio.ensure_future(price_batcher.get('ethereum', 'usd'))
+            return await asyncio.wait_for(
+                asyncio.gather(first, second), timeout=1)
+
+        res_1, res_2 = asyncio.get_event_loop().run_until_complete(main())
+        assert res_1 == {'bitcoin': {'usd': 1.0}}
+        assert res_2 == {'ethereum': {'usd': 3.0}}
+        assert len(calls) == 2  # second call got its own batch window
+
+    def test_cancelled_caller_does_not_strand_the_batch(self):
+        async def slow_fetch(params):
+            await asyncio.sleep(0.1)
+            return self.prices
+
+        price_batcher = batcher.SimplePriceBatcher(slow_fetch, max_wait=0.01)
+
+        async def main():
+            doomed = asyncio.ensure_future(price_batcher.get('bitcoin', 'usd'))
+            survivor = asyncio.ensure_future(
+                price_batcher.get('ethereum', 'usd'))
+            # cancel one caller mid-fetch (e.g. its client disconnected)
+            await asyncio.sleep(0.05)
+            doomed.cancel()
+            return await asyncio.wait_for(survivor, timeout=1)
+
+        result = asyncio.get_event_loop().run_until_complete(main())
+        assert result == {'ethereum': {'usd': 3.0}}